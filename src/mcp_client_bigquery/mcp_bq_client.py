@@ -1,33 +1,53 @@
+import base64
+import httpx
 import requests
 import json
-
-try:
-    from sseclient import SSEClient
-except ImportError:
-    SSEClient = None
+from requests.adapters import HTTPAdapter
 
 SERVER_URL = "http://localhost:8080"  # Change if needed
 
+# Reuse connections across calls instead of opening a new one per request
+_session = requests.Session()
+_session.mount("http://", HTTPAdapter(pool_maxsize=100))
+_session.mount("https://", HTTPAdapter(pool_maxsize=100))
+
 def list_tables():
-    resp = requests.get(f"{SERVER_URL}/list-tables")
+    resp = _session.get(f"{SERVER_URL}/list-tables")
     print(json.dumps(resp.json(), indent=2))
 
 def describe_table(table_name):
-    resp = requests.post(f"{SERVER_URL}/describe-table", json={"table_name": table_name})
+    resp = _session.post(f"{SERVER_URL}/describe-table", json={"table_name": table_name})
     print(json.dumps(resp.json(), indent=2))
 
 def execute_query(query):
-    resp = requests.post(f"{SERVER_URL}/execute-query", json={"query": query})
+    resp = _session.post(f"{SERVER_URL}/execute-query", json={"query": query})
     print(json.dumps(resp.json(), indent=2))
 
 def execute_query_sse(query):
-    if SSEClient is None:
-        print("Please install sseclient: pip install sseclient")
-        return
-    resp = requests.post(f"{SERVER_URL}/execute-query-sse", json={"query": query}, stream=True)
-    client = SSEClient(resp)
-    for event in client.events():
-        print(event.data)
+    # No read timeout: rows may arrive slowly while BigQuery pages through results
+    with httpx.stream("POST", f"{SERVER_URL}/execute-query-sse", json={"query": query}, timeout=None) as resp:
+        for line in resp.iter_lines():
+            if line.startswith("data:"):
+                print(line[5:].lstrip())
+
+def execute_query_arrow(query):
+    import pyarrow
+
+    chunks = []
+    event = None
+    headers = {"Accept": "application/vnd.apache.arrow.stream"}
+    with httpx.stream("POST", f"{SERVER_URL}/execute-query-sse", json={"query": query}, headers=headers, timeout=None) as resp:
+        for line in resp.iter_lines():
+            if line.startswith("event:"):
+                event = line[6:].strip()
+            elif line.startswith("data:"):
+                data = line[5:].strip()
+                if event == "error":
+                    print(f"Error: {json.loads(data)}")
+                    return
+                chunks.append(base64.b64decode(data))
+    table = pyarrow.ipc.open_stream(b"".join(chunks)).read_all()
+    print(json.dumps(table.to_pylist(), indent=2, default=str))
 
 if __name__ == "__main__":
     import sys
@@ -38,6 +58,7 @@ if __name__ == "__main__":
     parser.add_argument("--describe-table", help="Describe a table (format: dataset.table)")
     parser.add_argument("--execute-query", help="Execute a SQL query")
     parser.add_argument("--execute-query-sse", help="Execute a SQL query with SSE streaming")
+    parser.add_argument("--execute-query-arrow", help="Execute a SQL query with Arrow streaming (requires pyarrow)")
     parser.add_argument("--server-url", default=SERVER_URL, help="Server URL (default: http://localhost:8080)")
 
     args = parser.parse_args()
@@ -51,5 +72,7 @@ if __name__ == "__main__":
         execute_query(args.execute_query)
     elif args.execute_query_sse:
         execute_query_sse(args.execute_query_sse)
+    elif args.execute_query_arrow:
+        execute_query_arrow(args.execute_query_arrow)
     else:
         parser.print_help() 
\ No newline at end of file
@@ -1,13 +1,34 @@
-from fastapi import FastAPI, Request
-from fastapi.responses import JSONResponse
+from fastapi import Depends, FastAPI, Request
+from fastapi.responses import JSONResponse, StreamingResponse
 from fastmcp import FastMCP
-from typing import Any, Optional
+from pydantic import BaseModel, field_validator
+from pydantic_settings import BaseSettings, NoDecode, SettingsConfigDict
+from typing import Annotated, Any, Iterator, Optional
+from functools import lru_cache
+from contextlib import asynccontextmanager, suppress
+from decimal import Decimal
 from google.cloud import bigquery
 from google.oauth2 import service_account
+from requests.adapters import HTTPAdapter
+try:
+    from google.cloud import bigquery_storage
+except ImportError:
+    bigquery_storage = None
+try:
+    import pyarrow
+except ImportError:
+    pyarrow = None
 import logging
 import os
 import uvicorn
-import json
+import orjson
+import asyncio
+import re
+import base64
+import copy
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from cachetools import TTLCache, cached
 # --- Add these imports for SSE transport ---
 from mcp.server.sse import SseServerTransport
 from starlette.routing import Mount
@@ -15,23 +36,114 @@ from starlette.routing import Mount
 # --- Logging Setup ---
 logger = logging.getLogger('mcp_bigquery_server')
 handler_stdout = logging.StreamHandler()
-handler_file = logging.FileHandler('/tmp/mcp_bigquery_server.log')
 formatter = logging.Formatter('%(asctime)s - %(name)s - %(levelname)s - %(message)s')
 handler_stdout.setFormatter(formatter)
-handler_file.setFormatter(formatter)
 logger.addHandler(handler_stdout)
-logger.addHandler(handler_file)
-logger.setLevel(logging.DEBUG)
+# Set LOG_FILE to an empty string to disable file logging in production.
+log_file = os.getenv("LOG_FILE", "/tmp/mcp_bigquery_server.log")
+if log_file:
+    handler_file = logging.FileHandler(log_file)
+    handler_file.setFormatter(formatter)
+    logger.addHandler(handler_file)
+logger.setLevel(os.getenv("LOG_LEVEL", "INFO").upper())
 logger.info("Starting MCP BigQuery Server (FastMCP)")
 
+# --- Settings ---
+class Settings(BaseSettings):
+    # Empty variables count as unset, as they did with the previous os.getenv parsing.
+    model_config = SettingsConfigDict(env_ignore_empty=True)
+
+    bq_project_id: Optional[str] = None
+    bq_location: Optional[str] = None
+    bq_key_file: Optional[str] = None
+    bq_datasets: Annotated[list[str], NoDecode] = []
+    bq_http_pool_size: int = 100
+    bq_storage_min_rows: int = 10000
+    bq_storage_endpoint: str = "bigquerystorage.googleapis.com"
+    bq_maximum_bytes_billed: Optional[int] = None
+    bq_query_cache_ttl: int = 0
+    mcp_workers: int = 1
+    mcp_limit_concurrency: int = 256
+    mcp_timeout_keep_alive: int = 75
+
+    @field_validator("bq_datasets", mode="before")
+    @classmethod
+    def split_datasets(cls, value: Any) -> Any:
+        if isinstance(value, str):
+            return [dataset for dataset in value.split(",") if dataset]
+        return value
+
+@lru_cache
+def get_settings() -> Settings:
+    return Settings()
+
 # --- FastAPI and FastMCP Setup ---
-app = FastAPI(title="MCP BigQuery Server", description="BigQuery MCP server with FastMCP transport", version="0.3.0")
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    # With MCP_WORKERS > 1 each worker process imports the app fresh and builds its
+    # own client from the environment prepared by main().
+    if app.state.db is None:
+        init_db_from_env()
+    yield
+
+app = FastAPI(title="MCP BigQuery Server", description="BigQuery MCP server with FastMCP transport", version="0.3.0", lifespan=lifespan)
 mcp = FastMCP("bigquery")
 
+def _json_default(value: Any) -> Any:
+    # Types orjson cannot encode natively: BYTES columns are base64-encoded, as in
+    # the BigQuery REST API, and NUMERIC/BIGNUMERIC keep full precision as strings.
+    if isinstance(value, bytes):
+        return base64.b64encode(value).decode()
+    if isinstance(value, Decimal):
+        return str(value)
+    raise TypeError(f"Object of type {type(value).__name__} is not JSON serializable")
+
+def _dumps(value: Any) -> str:
+    return orjson.dumps(value, default=_json_default, option=orjson.OPT_INDENT_2).decode()
+
+def _rows_to_dicts(results: Any) -> Iterator[dict[str, Any]]:
+    # Resolve the field names once instead of calling Row.items() on every row.
+    fields = tuple(field.name for field in results.schema)
+    for row in results:
+        yield dict(zip(fields, row.values()))
+
+# --- Metadata Caches ---
+# Table listings and schemas change rarely, so they are cached for a few minutes
+# and dropped whenever a DDL statement goes through execute_query.
+_tables_cache: TTLCache = TTLCache(maxsize=1024, ttl=300)
+_schema_cache: TTLCache = TTLCache(maxsize=1024, ttl=300)
+_metadata_lock = threading.RLock()
+def _tables_key(db: Any) -> tuple:
+    return (tuple(db.datasets_filter),)
+
+# Dedicated pool for fanning out per-dataset list_tables RPCs. Both list_tables and
+# alist_tables go through it, so the fan-out never competes with query threads in
+# asyncio's default executor.
+_metadata_executor = ThreadPoolExecutor(max_workers=16, thread_name_prefix="bq-metadata")
+_DDL_PATTERN = re.compile(r"^(CREATE|DROP|ALTER)\b", re.IGNORECASE)
+_DATASET_ID_PATTERN = re.compile(r"^[A-Za-z0-9_]+$")
+
+# --- Query Result Cache ---
+_READ_ONLY_PATTERN = re.compile(r"^\s*(WITH|SELECT)\b", re.IGNORECASE)
+
+def _normalize_statement(query: str) -> str:
+    # Agents usually end statements with ";", which does not make them scripts.
+    return query.strip().rstrip("; \t\r\n")
+
+def _is_multi_statement(query: str) -> bool:
+    return ";" in _normalize_statement(query)
+
+def _is_read_only(query: str) -> bool:
+    # An inner ";" may hide a second statement after the SELECT, so treat it as a write.
+    return _READ_ONLY_PATTERN.match(query) is not None and not _is_multi_statement(query)
+
 # --- BigQuery Database Helper ---
 class BigQueryDatabase:
-    def __init__(self, project: str, location: str, key_file: Optional[str], datasets_filter: list[str]):
-        logger.info(f"Initializing BigQuery client for project: {project}, location: {location}, key_file: {key_file}")
+    def __init__(self, project: str, location: str, key_file: Optional[str], datasets_filter: list[str], http_pool_size: int = 100,
+                 storage_min_rows: int = 10000, storage_endpoint: str = "bigquerystorage.googleapis.com",
+                 maximum_bytes_billed: Optional[int] = None, query_cache_ttl: int = 0,
+                 warm_up: bool = True):
+        logger.info("Initializing BigQuery client for project: %s, location: %s, key_file: %s", project, location, key_file)
         if not project:
             raise ValueError("Project is required")
         if not location:
@@ -44,94 +156,228 @@ class BigQueryDatabase:
                     scopes=["https://www.googleapis.com/auth/cloud-platform"],
                 )
             except Exception as e:
-                logger.error(f"Error loading service account credentials: {e}")
+                logger.error("Error loading service account credentials: %s", e)
                 raise ValueError(f"Invalid key file: {e}")
         self.client = bigquery.Client(credentials=credentials, project=project, location=location)
+        # The default requests pool (10 connections) is too small for concurrent queries
+        # and metadata fan-out, so mount a larger one on both the API and auth sessions.
+        adapter = HTTPAdapter(pool_connections=http_pool_size, pool_maxsize=http_pool_size, max_retries=3)
+        self.client._http.mount("https://", adapter)
+        auth_request = getattr(self.client._http, "_auth_request", None)
+        if auth_request is not None:
+            auth_request.session.mount("https://", adapter)
         self.datasets_filter = datasets_filter
+        # Large results are read through the Storage Read API (Arrow over gRPC)
+        # when the optional bigquery-storage dependency is installed. Metadata and
+        # query jobs stay on REST, the only transport the BigQuery v2 API offers.
+        self.storage_min_rows = storage_min_rows
+        self.bqstorage_client = None
+        if bigquery_storage is not None:
+            self.bqstorage_client = bigquery_storage.BigQueryReadClient(
+                credentials=self.client._credentials,
+                client_options={"api_endpoint": storage_endpoint},
+            )
+        # Shared defaults for every query job; _job_config() copies it per call.
+        self._base_cfg = bigquery.QueryJobConfig(
+            use_query_cache=True,
+            use_legacy_sql=False,
+            priority=bigquery.QueryPriority.INTERACTIVE,
+        )
+        # The setter stores str(value), so passing None would send "None" as the limit.
+        if maximum_bytes_billed is not None:
+            self._base_cfg.maximum_bytes_billed = maximum_bytes_billed
+        # Opt-in memoization of identical read-only queries (query_cache_ttl > 0).
+        self._query_cache: Optional[TTLCache] = None
+        if query_cache_ttl > 0:
+            self._query_cache = TTLCache(maxsize=512, ttl=query_cache_ttl)
+        self._query_cache_lock = threading.RLock()
+        if warm_up:
+            self._warm_up()
+
+    def _warm_up(self) -> None:
+        # Pay the OAuth token exchange and table discovery at startup rather than
+        # on the first real request.
+        logger.debug("Warming up BigQuery client")
+        try:
+            self.client.query("SELECT 1", job_config=self._job_config()).result()
+        except Exception as e:
+            logger.warning("BigQuery warm-up failed: %s", e)
+        self._refresh_tables()
+
+    def _refresh_tables(self) -> None:
+        # Seeds the table listing cache and re-seeds it in the background shortly
+        # before it expires, so list_tables calls never wait on a cold cache.
+        try:
+            tables = self._list_tables_uncached()
+            with _metadata_lock:
+                _tables_cache[_tables_key(self)] = tables
+        except Exception as e:
+            logger.warning("Refreshing table listing failed: %s", e)
+        timer = threading.Timer(_tables_cache.ttl * 0.9, self._refresh_tables)
+        timer.daemon = True
+        timer.start()
+
+    def _job_config(self, params: list[Any] | None = None) -> bigquery.QueryJobConfig:
+        # QueryJobConfig keeps its state in a nested dict, so a shallow copy would
+        # leak query parameters back into the base config.
+        cfg = copy.deepcopy(self._base_cfg)
+        cfg.query_parameters = params or []
+        return cfg
+
+    async def aexecute_query(self, query: str, params: dict[str, Any] | None = None) -> list[dict[str, Any]]:
+        return await asyncio.to_thread(self.execute_query, query, params)
+
+    async def alist_tables(self) -> list[str]:
+        return await asyncio.to_thread(self.list_tables)
+
+    async def adescribe_table(self, table_name: str) -> list[dict[str, Any]]:
+        return await asyncio.to_thread(self.describe_table, table_name)
 
     def execute_query(self, query: str, params: dict[str, Any] | None = None) -> list[dict[str, Any]]:
-        logger.debug(f"Executing query: {query}")
+        logger.debug("Executing query: %s", query)
+        read_only = _is_read_only(query)
+        cache_key = None
+        if self._query_cache is not None and read_only and params is None:
+            cache_key = _normalize_statement(query)
+            with self._query_cache_lock:
+                rows = self._query_cache.get(cache_key)
+            if rows is not None:
+                logger.debug("Query cache hit, returning %s rows", len(rows))
+                return rows
         try:
-            if params:
-                job = self.client.query(query, job_config=bigquery.QueryJobConfig(query_parameters=params))
-            else:
-                job = self.client.query(query)
+            job = self.client.query(query, job_config=self._job_config(params))
             results = job.result()
-            rows = [dict(row.items()) for row in results]
-            logger.debug(f"Query returned {len(rows)} rows")
+            if self.bqstorage_client is not None and (results.total_rows or 0) >= self.storage_min_rows:
+                logger.debug("Reading %s rows via the Storage Read API", results.total_rows)
+                rows = results.to_arrow(bqstorage_client=self.bqstorage_client).to_pylist()
+            else:
+                rows = list(_rows_to_dicts(results))
+            logger.debug("Query returned %s rows", len(rows))
+            if cache_key is not None:
+                with self._query_cache_lock:
+                    self._query_cache[cache_key] = rows
+            self._invalidate_after(query)
             return rows
         except Exception as e:
-            logger.error(f"Database error executing query: {e}")
+            logger.error("Database error executing query: %s", e)
             raise
 
+    def iter_execute_query(self, query: str) -> Iterator[dict[str, Any]]:
+        logger.debug("Streaming query: %s", query)
+        results = self.client.query(query, job_config=self._job_config()).result()
+        self._invalidate_after(query)
+        yield from _rows_to_dicts(results)
+
+    def iter_arrow_batches(self, query: str, batch_size: int = 1000) -> Iterator[Any]:
+        logger.debug("Streaming query as Arrow: %s", query)
+        results = self.client.query(query, job_config=self._job_config()).result(page_size=batch_size)
+        self._invalidate_after(query)
+        if not results.total_rows:
+            # to_arrow_iterable yields nothing for an empty result; send one empty
+            # batch so clients still receive the column schema.
+            yield pyarrow.RecordBatch.from_pylist([], schema=results.to_arrow().schema)
+            return
+        yield from results.to_arrow_iterable(bqstorage_client=self.bqstorage_client)
+
+    def _invalidate_after(self, query: str) -> None:
+        # Called once a statement has finished, from both the buffered and the
+        # streaming paths, so writes never leave cached results or metadata behind.
+        if _is_read_only(query):
+            return
+        if self._query_cache is not None:
+            with self._query_cache_lock:
+                self._query_cache.clear()
+        if _DDL_PATTERN.match(query.strip()) or _is_multi_statement(query):
+            self.invalidate()
+
+    def invalidate(self) -> None:
+        logger.debug("Invalidating metadata caches")
+        with _metadata_lock:
+            _tables_cache.clear()
+            _schema_cache.clear()
+
+    @cached(cache=_tables_cache, key=_tables_key, lock=_metadata_lock)
     def list_tables(self) -> list[str]:
+        return self._list_tables_uncached()
+
+    @cached(cache=_schema_cache, key=lambda self, table_name: table_name, lock=_metadata_lock)
+    def describe_table(self, table_name: str) -> list[dict[str, Any]]:
+        return self._describe_table_uncached(table_name)
+
+    def _list_tables_uncached(self) -> list[str]:
         logger.debug("Listing all tables")
-        if self.datasets_filter:
-            datasets = [self.client.dataset(dataset) for dataset in self.datasets_filter]
-        else:
-            datasets = list(self.client.list_datasets())
-        logger.debug(f"Found {len(datasets)} datasets")
-        tables = []
-        for dataset in datasets:
-            dataset_tables = self.client.list_tables(dataset.dataset_id)
-            tables.extend([
-                f"{dataset.dataset_id}.{table.table_id}" for table in dataset_tables
-            ])
-        logger.debug(f"Found {len(tables)} tables")
+        datasets = self._resolve_datasets()
+        logger.debug("Found %s datasets", len(datasets))
+        dataset_tables = _metadata_executor.map(
+            self._list_dataset_tables, [dataset.dataset_id for dataset in datasets]
+        )
+        tables = [table for tables_in_dataset in dataset_tables for table in tables_in_dataset]
+        logger.debug("Found %s tables", len(tables))
         return tables
 
-    def describe_table(self, table_name: str) -> list[dict[str, Any]]:
-        logger.debug(f"Describing table: {table_name}")
+    def _resolve_datasets(self) -> list[Any]:
+        if self.datasets_filter:
+            return [self.client.dataset(dataset) for dataset in self.datasets_filter]
+        return list(self.client.list_datasets())
+
+    def _list_dataset_tables(self, dataset_id: str) -> list[str]:
+        return [f"{dataset_id}.{table.table_id}" for table in self.client.list_tables(dataset_id)]
+
+    def _describe_table_uncached(self, table_name: str) -> list[dict[str, Any]]:
+        logger.debug("Describing table: %s", table_name)
         parts = table_name.split(".")
         if len(parts) != 2:
             raise ValueError(f"Invalid table name: {table_name}")
         dataset_id, table_id = parts
-        query = f"""
-            SELECT ddl
-            FROM {dataset_id}.INFORMATION_SCHEMA.TABLES
-            WHERE table_name = @table_name;
-        """
-        return self.execute_query(query, params=[
-            bigquery.ScalarQueryParameter("table_name", "STRING", table_id),
-        ])
+        if not _DATASET_ID_PATTERN.match(dataset_id):
+            raise ValueError(f"Invalid dataset name: {dataset_id}")
+        table = self.client.get_table(f"{dataset_id}.{table_id}")
+        # to_api_repr() keeps the nested "fields" of RECORD/STRUCT columns.
+        return [field.to_api_repr() for field in table.schema]
 
-# --- MCP Tool Implementations ---
-# These will be registered with FastMCP
-_db: Optional[BigQueryDatabase] = None
+# --- Database Access ---
+# The database lives on app.state; FastAPI routes receive it through Depends(get_db).
+# MCP tools are not FastAPI routes, so they read it from app.state directly.
+app.state.db = None
 
-def get_db():
-    global _db
-    if _db is None:
+def _require_db(state: Any) -> BigQueryDatabase:
+    db = state.db
+    if db is None:
         raise RuntimeError("BigQueryDatabase not initialized")
-    return _db
+    return db
+
+def get_db(request: Request) -> BigQueryDatabase:
+    return _require_db(request.app.state)
 
+# --- MCP Tool Implementations ---
+# These will be registered with FastMCP
 @mcp.tool()
 async def execute_query(query: str) -> str:
     """Execute a SELECT query on the BigQuery database."""
-    db = get_db()
+    db = _require_db(app.state)
     try:
-        results = db.execute_query(query)
-        return json.dumps(results, indent=2)
+        results = await db.aexecute_query(query)
+        return _dumps(results)
     except Exception as e:
         return f"Error: {e}"
 
 @mcp.tool()
 async def list_tables() -> str:
     """List all tables in the BigQuery database."""
-    db = get_db()
+    db = _require_db(app.state)
     try:
-        tables = db.list_tables()
-        return json.dumps(tables, indent=2)
+        tables = await db.alist_tables()
+        return _dumps(tables)
     except Exception as e:
         return f"Error: {e}"
 
 @mcp.tool()
 async def describe_table(table_name: str) -> str:
     """Get the schema information for a specific table."""
-    db = get_db()
+    db = _require_db(app.state)
     try:
-        schema = db.describe_table(table_name)
-        return json.dumps(schema, indent=2)
+        schema = await db.adescribe_table(table_name)
+        return _dumps(schema)
     except Exception as e:
         return f"Error: {e}"
 
@@ -140,6 +386,78 @@ async def describe_table(table_name: str) -> str:
 async def mcp_status():
     return {"status": "ok", "message": "MCP BigQuery server is running.", "sse_endpoint": "/mcp/sse"}
 
+# --- Streaming Query Endpoint ---
+class QueryRequest(BaseModel):
+    query: str
+
+_STREAM_END = object()
+ARROW_STREAM_MEDIA_TYPE = "application/vnd.apache.arrow.stream"
+_ARROW_EOS = b"\xff\xff\xff\xff\x00\x00\x00\x00"
+
+def _json_frames(rows: Iterator[dict[str, Any]]) -> Iterator[bytes]:
+    for row in rows:
+        yield b"event: row\ndata: " + orjson.dumps(row, default=_json_default) + b"\n\n"
+
+def _arrow_frames(batches: Iterator[Any]) -> Iterator[bytes]:
+    # Each frame carries one base64-encoded Arrow IPC message: the schema first,
+    # then one per record batch, then the end-of-stream marker. Concatenating the
+    # decoded frames yields a stream readable with pyarrow.ipc.open_stream.
+    batches = iter(batches)
+    first = next(batches)
+    yield _arrow_frame(first.schema.serialize().to_pybytes())
+    yield _arrow_frame(first.serialize().to_pybytes())
+    for batch in batches:
+        yield _arrow_frame(batch.serialize().to_pybytes())
+    yield _arrow_frame(_ARROW_EOS)
+
+def _arrow_frame(message: bytes) -> bytes:
+    return b"event: arrow\ndata: " + base64.b64encode(message) + b"\n\n"
+
+@app.post("/execute-query-sse")
+async def execute_query_sse(body: QueryRequest, request: Request, db: BigQueryDatabase = Depends(get_db)):
+    # Clients that accept Arrow get columnar record batches; everyone else gets JSON rows.
+    if pyarrow is not None and ARROW_STREAM_MEDIA_TYPE in request.headers.get("accept", ""):
+        frames = _arrow_frames(db.iter_arrow_batches(body.query))
+    else:
+        frames = _json_frames(db.iter_execute_query(body.query))
+
+    async def generator():
+        # Bounded queue between the BigQuery reader and the HTTP writer, so a slow
+        # client applies backpressure instead of rows piling up in memory.
+        queue: asyncio.Queue = asyncio.Queue(maxsize=100)
+
+        async def produce():
+            try:
+                try:
+                    while True:
+                        frame = await asyncio.to_thread(next, frames, _STREAM_END)
+                        if frame is _STREAM_END:
+                            break
+                        await queue.put(frame)
+                except Exception as e:
+                    logger.error("Database error streaming query: %s", e)
+                    await queue.put(b"event: error\ndata: " + orjson.dumps(str(e)) + b"\n\n")
+                # Not reached on cancellation: once the client is gone nobody drains
+                # the queue, and blocking on the sentinel would leak this task.
+                await queue.put(_STREAM_END)
+            finally:
+                # Fails with ValueError while a cancelled next() is still running in
+                # its thread; the generator is then released when that call returns.
+                with suppress(ValueError):
+                    frames.close()
+
+        producer = asyncio.create_task(produce())
+        try:
+            while True:
+                frame = await queue.get()
+                if frame is _STREAM_END:
+                    break
+                yield frame
+        finally:
+            producer.cancel()
+
+    return StreamingResponse(generator(), media_type="text/event-stream")
+
 # --- MCP SSE Transport Integration ---
 # Create the SSE transport
 sse = SseServerTransport("/mcp/messages")
@@ -157,13 +475,15 @@ async def handle_sse(request: Request):
 
 # --- Initialization Logic ---
 def init_db_from_env():
-    project = os.getenv("BQ_PROJECT_ID")
-    location = os.getenv("BQ_LOCATION")
-    key_file = os.getenv("BQ_KEY_FILE")
-    datasets = os.getenv("BQ_DATASETS", "").split(",") if os.getenv("BQ_DATASETS") else []
-    global _db
-    _db = BigQueryDatabase(project, location, key_file, datasets)
-    logger.info(f"BigQueryDatabase initialized from env: project={project}, location={location}, key_file={key_file}, datasets={datasets}")
+    settings = get_settings()
+    app.state.db = BigQueryDatabase(
+        settings.bq_project_id, settings.bq_location, settings.bq_key_file, settings.bq_datasets,
+        http_pool_size=settings.bq_http_pool_size, storage_min_rows=settings.bq_storage_min_rows,
+        storage_endpoint=settings.bq_storage_endpoint,
+        maximum_bytes_billed=settings.bq_maximum_bytes_billed,
+        query_cache_ttl=settings.bq_query_cache_ttl,
+    )
+    logger.info("BigQueryDatabase initialized from env: project=%s, location=%s, key_file=%s, datasets=%s", settings.bq_project_id, settings.bq_location, settings.bq_key_file, settings.bq_datasets)
 
 def main():
     # Optionally parse CLI args or just use env vars
@@ -184,8 +504,22 @@ def main():
         os.environ["BQ_KEY_FILE"] = args.key_file
     if args.dataset:
         os.environ["BQ_DATASETS"] = ",".join(args.dataset)
-    init_db_from_env()
-    uvicorn.run(app, host="0.0.0.0", port=args.port)
+    settings = get_settings()
+    workers = settings.mcp_workers
+    if workers == 1:
+        init_db_from_env()
+    # "auto" picks uvloop and httptools when installed (uvicorn[standard]) and falls
+    # back to asyncio/h11 on platforms without them.
+    uvicorn.run(
+        "mcp_server_bigquery.server:app" if workers > 1 else app,
+        host="0.0.0.0",
+        port=args.port,
+        loop="auto",
+        http="auto",
+        workers=workers,
+        limit_concurrency=settings.mcp_limit_concurrency,
+        timeout_keep_alive=settings.mcp_timeout_keep_alive,
+    )
 
 if __name__ == "__main__":
     main()